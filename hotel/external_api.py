@@ -1,3 +1,4 @@
+import asyncio
 import json
 import random
 import uuid
@@ -131,3 +132,17 @@ def get_guest_details(guest_id: str) -> str:
             "Country": countries[random.randint(0, len(countries) - 1)],
         }
     )
+
+
+async def aget_reservation_details(reservation_id: str) -> str:
+    """
+    Async variant of get_reservation_details, so the details of multiple reservations can be fetched concurrently.
+    """
+    return await asyncio.to_thread(get_reservation_details, reservation_id)
+
+
+async def aget_guest_details(guest_id: str) -> str:
+    """
+    Async variant of get_guest_details, so the details of multiple guests can be fetched concurrently.
+    """
+    return await asyncio.to_thread(get_guest_details, guest_id)
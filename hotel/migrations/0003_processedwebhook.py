@@ -0,0 +1,21 @@
+# Generated by Django 4.2.2 on 2026-10-14 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0002_hotel_pms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedWebhook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload_hash', models.CharField(max_length=64, unique=True)),
+                ('processed_at', models.DateTimeField(help_text='When the handling of this payload last started.')),
+            ],
+        ),
+    ]
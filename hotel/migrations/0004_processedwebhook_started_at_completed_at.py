@@ -0,0 +1,28 @@
+# Generated by Django 4.2.2 on 2026-10-14 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0003_processedwebhook'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='processedwebhook',
+            old_name='processed_at',
+            new_name='started_at',
+        ),
+        migrations.AlterField(
+            model_name='processedwebhook',
+            name='started_at',
+            field=models.DateTimeField(db_index=True, help_text='When the handling of this payload last started.'),
+        ),
+        migrations.AddField(
+            model_name='processedwebhook',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, help_text='When the handling that started at started_at completed, empty while it is in progress.', null=True),
+        ),
+    ]
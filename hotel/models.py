@@ -1,4 +1,8 @@
-from django.db import models
+import datetime
+from typing import Optional
+
+from django.db import connection, models
+from django.utils import timezone
 
 
 class Language(models.TextChoices):
@@ -87,4 +91,66 @@ class Stay(models.Model):
         unique_together = ("hotel", "pms_reservation_id")
 
 
+class ProcessedWebhook(models.Model):
+    """
+    Webhooks have no event IDs, so a webhook is identified by a hash of its payload.
+    A webhook does not need to be handled if the handling of an identical one started after it was
+    received and completed, as that already fetched the latest details from the PMS.
+    """
+
+    payload_hash = models.CharField(max_length=64, unique=True)
+    started_at = models.DateTimeField(db_index=True, help_text="When the handling of this payload last started.")
+    completed_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="When the handling that started at started_at completed, empty while it is in progress.",
+    )
+
+    @classmethod
+    def is_handled_since(cls, payload_hash: str, received_at: datetime.datetime) -> bool:
+        """
+        Returns whether an identical webhook was handled completely since received_at.
+        """
+        return cls.objects.filter(
+            payload_hash=payload_hash, started_at__gte=received_at, completed_at__isnull=False
+        ).exists()
+
+    @classmethod
+    def claim(
+        cls, payload_hash: str, received_at: datetime.datetime, stale_after: datetime.timedelta
+    ) -> Optional[datetime.datetime]:
+        """
+        Claims the handling of a webhook that was received at received_at.
+        A claim is taken over if it started before received_at, or if it did not complete within stale_after,
+        e.g. because the worker died. Returns the started_at of the new claim, or None if an identical webhook
+        is being handled or was handled since received_at.
+        """
+        # The claim is created or taken over in a single query, as this is done for every webhook.
+        now = timezone.now()
+        table = connection.ops.quote_name(cls._meta.db_table)
+        adapt = connection.ops.adapt_datetimefield_value
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (payload_hash, started_at, completed_at) VALUES (%s, %s, NULL) "
+                f"ON CONFLICT (payload_hash) DO UPDATE SET started_at = excluded.started_at, completed_at = NULL "
+                f"WHERE {table}.started_at < %s OR ({table}.completed_at IS NULL AND {table}.started_at < %s)",
+                [payload_hash, adapt(now), adapt(received_at), adapt(now - stale_after)],
+            )
+            return now if cursor.rowcount else None
+
+    @classmethod
+    def complete(cls, payload_hash: str, started_at: datetime.datetime) -> None:
+        """
+        Marks the claim that started at started_at as completed, unless it was taken over in the meantime.
+        """
+        cls.objects.filter(payload_hash=payload_hash, started_at=started_at).update(completed_at=timezone.now())
+
+    @classmethod
+    def release(cls, payload_hash: str, started_at: datetime.datetime) -> None:
+        """
+        Releases the claim that started at started_at, unless it was taken over in the meantime.
+        """
+        cls.objects.filter(payload_hash=payload_hash, started_at=started_at).delete()
+
+
 from . import pms_systems  # noqa: E402
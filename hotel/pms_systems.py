@@ -1,17 +1,42 @@
 from abc import ABC, abstractmethod
-import inspect
-import sys
+import asyncio
+import datetime
+import logging
 
-from typing import Optional, Type, TypedDict
+from typing import Awaitable, Callable, Optional, Type, TypedDict
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+try:
+    # orjson parses webhook payloads and API responses a lot faster than the standard library.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from hotel.external_api import (
     get_reservations_for_given_checkin_date,
-    get_reservation_details,
-    get_guest_details,
+    aget_reservation_details,
+    aget_guest_details,
     APIError,
 )
 
-from hotel.models import Stay, Hotel
+from hotel.models import Guest, Stay, Hotel
+from hotel.utils import DEFAULT_LANGUAGE, LANGUAGE_MAPPINGS, STATUS_MAPPINGS, normalize_phone_number
+
+
+logger = logging.getLogger(__name__)
+
+# Guest details fetched for a webhook are cached for its retries, so a retry only fetches the guests
+# that failed before. This is longer than all retries of process_webhook (5 times 60s).
+GUEST_DETAILS_CACHE_TIMEOUT = 10 * 60
+
+# Hotels are looked up for every webhook, but hardly ever change. A local memory cache is only cleared
+# in the process that saved the hotel, so the other processes only keep hotel IDs for a short while.
+HOTEL_ID_CACHE_TIMEOUT = 60 * 60
+LOCAL_HOTEL_ID_CACHE_TIMEOUT = 10
 
 
 class CleanedWebhookPayload(TypedDict):
@@ -19,11 +44,19 @@ class CleanedWebhookPayload(TypedDict):
     data: dict
 
 
+# All PMS classes by their lowercase name, filled as the classes are defined.
+PMS_REGISTRY: dict[str, Type["PMS"]] = {}
+
+
 class PMS(ABC):
     """
     Abstract class for Property Management Systems.
     """
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        PMS_REGISTRY[cls.__name__[4:].lower()] = cls
+
     def __init__(self, hotel: Hotel):
         assert hotel is not None
 
@@ -43,10 +76,11 @@ class PMS(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def handle_webhook(self, webhook_data: dict) -> bool:
+    def handle_webhook(self, webhook_data: dict, retry_key: Optional[str] = None) -> bool:
         """
         This method is called when we receive a webhook from the PMS.
         Handle webhook handles the events and updates relevant models in the database.
+        Retries of the same webhook pass the same retry_key, so they can reuse what was fetched before.
         Requirements:
             - Now that the PMS has notified you about an update of a reservation, you need to
                 get more details of this reservation. For this, you can use the mock API
@@ -58,13 +92,257 @@ class PMS(ABC):
         raise NotImplementedError
 
 
+async def afetch_api_details(api_call: Callable[[str], Awaitable[str]], object_id: str) -> Optional[dict]:
+    """
+    Calls the external API and returns the decoded details, or None if the call failed
+    or returned something that is not a JSON object.
+    """
+    try:
+        details = json_loads(await api_call(object_id))
+    except (APIError, ValueError) as e:
+        logger.warning("Could not fetch details for %s from %s: %s", object_id, api_call.__name__, e)
+        return None
+    if not isinstance(details, dict):
+        logger.warning("Invalid details for %s from %s: %r", object_id, api_call.__name__, details)
+        return None
+    return details
+
+
+def hotel_id_cache_key(pms_name: str, pms_hotel_id: str) -> str:
+    return f"{pms_name}:hotel_id:{pms_hotel_id}"
+
+
+def get_hotel_id(pms_name: str, pms_hotel_id: str) -> Optional[int]:
+    """
+    Returns the ID of the hotel with the given PMS and PMS hotel ID, or None if there is no such hotel.
+    Found IDs are cached, the cache is cleared when a hotel is saved or deleted (see hotel/signals.py).
+    """
+    cache_key = hotel_id_cache_key(pms_name, pms_hotel_id)
+    hotel_id = cache.get(cache_key)
+    if hotel_id is None:
+        hotel_id = Hotel.objects.filter(pms=pms_name, pms_hotel_id=pms_hotel_id).values_list("id", flat=True).first()
+        if hotel_id is not None:
+            is_local = isinstance(caches["default"], LocMemCache)
+            cache.set(cache_key, hotel_id, timeout=LOCAL_HOTEL_ID_CACHE_TIMEOUT if is_local else HOTEL_ID_CACHE_TIMEOUT)
+    return hotel_id
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime.date]:
+    """
+    Parses a YYYY-MM-DD date string of the PMS, returning None if it is missing or invalid.
+    """
+    # Missing dates are common, they are handled without raising and catching an exception.
+    if not value:
+        return None
+    try:
+        # fromisoformat also accepts other ISO 8601 dates, like "20240120" and "2024-W03-6", which are not
+        # dates of the PMS. Unlike strptime, it does not need to parse a format string on every call.
+        if len(value) != 10 or value[4] != "-" or value[7] != "-":
+            return None
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
 class PMS_Apaleo(PMS):
     @classmethod
     def clean_webhook_payload(cls, payload: str) -> Optional[CleanedWebhookPayload]:
-        return None
+        try:
+            data = json_loads(payload)
+        except ValueError:
+            return None
+        if not isinstance(data, dict) or not isinstance(data.get("HotelId"), str):
+            return None
+
+        if not isinstance(data.get("Events"), list):
+            return None
+        # Only keep the fields that are used to handle the webhook, the rest of the
+        # payload does not need to be kept in memory or sent to the worker.
+        events = []
+        for event in data["Events"]:
+            if not isinstance(event, dict) or not isinstance(event.get("Value"), dict):
+                return None
+            reservation_id = event["Value"].get("ReservationId")
+            if not isinstance(reservation_id, str):
+                return None
+            events.append({"Name": event.get("Name"), "Value": {"ReservationId": reservation_id}})
+
+        hotel_id = get_hotel_id(cls.__name__[4:], data["HotelId"])
+        if hotel_id is None:
+            return None
+
+        return CleanedWebhookPayload(
+            hotel_id=hotel_id,
+            data={"HotelId": data["HotelId"], "IntegrationId": data.get("IntegrationId"), "Events": events},
+        )
+
+    async def afetch_details(
+        self, reservation_ids: list[str], retry_key: Optional[str] = None
+    ) -> tuple[bool, list[dict], list[Optional[dict]]]:
+        """
+        Fetches the details of the given reservations and of their guests. All reservations
+        are fetched at once, followed by all guests, so the API calls do not wait for each other.
+        Returns whether all details could be fetched, the details of the reservations of this hotel,
+        and the guest details of each of these reservations (None if they could not be fetched).
+        """
+        success = True
+        reservations = []
+        reservation_details = await asyncio.gather(
+            *(afetch_api_details(aget_reservation_details, reservation_id) for reservation_id in reservation_ids)
+        )
+        for reservation_id, details in zip(reservation_ids, reservation_details):
+            if details is None:
+                success = False
+            elif not isinstance(details.get("GuestId"), str):
+                logger.warning("Invalid guest ID for reservation %s: %r", reservation_id, details.get("GuestId"))
+                success = False
+            elif details.get("HotelId") != self.hotel.pms_hotel_id:
+                logger.warning("Reservation %s does not belong to hotel %s", reservation_id, self.hotel.pk)
+            else:
+                # The stay is stored under the requested ID, not under the ID echoed by the API.
+                reservations.append({**details, "ReservationId": reservation_id})
+
+        guest_details = await self.afetch_guest_details(
+            [reservation["GuestId"] for reservation in reservations], retry_key
+        )
+        return success, reservations, guest_details
+
+    async def afetch_guest_details(
+        self, guest_ids: list[str], retry_key: Optional[str] = None
+    ) -> list[Optional[dict]]:
+        """
+        Fetches the details of the given guests, or takes them from the cache if an earlier attempt with
+        the same retry_key fetched them. Other webhooks always fetch the guests, as they can have changed.
+        Reservation details are not cached, as a webhook means that the reservation has changed.
+        Returns the details of each guest, or None if they could not be fetched.
+        """
+        # A guest can have multiple reservations in the same webhook, e.g. when booking multiple rooms.
+        # Each guest is only fetched once.
+        cache_keys = {guest_id: f"{self.name}:guest_details:{retry_key}:{guest_id}" for guest_id in guest_ids}
+        cached_details = await cache.aget_many(list(cache_keys.values())) if retry_key else {}
+        details_by_guest_id = {
+            guest_id: cached_details[key] for guest_id, key in cache_keys.items() if key in cached_details
+        }
+
+        missing_guest_ids = [guest_id for guest_id in cache_keys if guest_id not in details_by_guest_id]
+        missing_details = await asyncio.gather(
+            *(afetch_api_details(aget_guest_details, guest_id) for guest_id in missing_guest_ids)
+        )
+        details_by_guest_id.update(zip(missing_guest_ids, missing_details))
+        if retry_key:
+            await cache.aset_many(
+                {
+                    cache_keys[guest_id]: details
+                    for guest_id, details in zip(missing_guest_ids, missing_details)
+                    if details is not None
+                },
+                timeout=GUEST_DETAILS_CACHE_TIMEOUT,
+            )
+        return [details_by_guest_id[guest_id] for guest_id in guest_ids]
+
+    def handle_webhook(self, webhook_data: dict, retry_key: Optional[str] = None) -> bool:
+        """
+        The webhook is handled in three passes, so the number of queries does not grow with
+        the number of events:
+            1. Collect the IDs of all reservations in the webhook.
+            2. Fetch the reservation and guest details concurrently from the external API.
+            3. Look up all existing guests and stays at once and bulk create or update them.
+        Returns False if not all details could be fetched, so the webhook can be handled again.
+        """
+        # Pass 1: a reservation can be mentioned in multiple events, it only needs to be handled once.
+        reservation_ids = list(dict.fromkeys(event["Value"]["ReservationId"] for event in webhook_data["Events"]))
+
+        # Pass 2: fetch the details of all reservations and their guests.
+        success, reservations, guest_details = async_to_sync(self.afetch_details)(reservation_ids, retry_key)
+
+        # Pass 3: guests are identified by their phone number, guests without a valid one are not stored.
+        # The API sometimes returns invalid data, so fields that are not strings are ignored.
+        phones = []
+        guest_details_by_phone = {}
+        for details in guest_details:
+            if details is None:
+                success = False
+                phones.append(None)
+                continue
+            details = {field: details.get(field) for field in ["Name", "Phone", "Country"]}
+            details = {field: value if isinstance(value, str) else None for field, value in details.items()}
+            phone = normalize_phone_number(details["Phone"], details["Country"])
+            phones.append(phone)
+            if phone:
+                guest_details_by_phone[phone] = details
+
+        # All database changes of the webhook are committed at once.
+        with transaction.atomic():
+            # Existing guests are fetched first, so missing details do not overwrite what we already know.
+            guests = Guest.objects.in_bulk(list(guest_details_by_phone), field_name="phone")
+            upserted_guests = []
+            # The lookups are bound to locals once, as the loops below run for every event.
+            language_for_country = LANGUAGE_MAPPINGS.get
+            status_for_reservation = STATUS_MAPPINGS.get
+            for phone, details in guest_details_by_phone.items():
+                guest = guests.get(phone)
+                name = details["Name"] or (guest.name if guest else "")
+                language = language_for_country(details["Country"], guest.language if guest else DEFAULT_LANGUAGE)
+                upserted_guests.append(Guest(phone=phone, name=name, language=language))
+            if upserted_guests:
+                # Creates and updates all guests in one query, also if a guest was created in the meantime.
+                # Primary keys are not returned on conflicts, so the guests are fetched again.
+                Guest.objects.bulk_create(
+                    upserted_guests,
+                    update_conflicts=True,
+                    unique_fields=["phone"],
+                    update_fields=["name", "language", "updated_at"],
+                )
+                guests = Guest.objects.in_bulk(list(guest_details_by_phone), field_name="phone")
+
+            # Stays are created or updated in one query per group. The current guest of a stay is kept
+            # if the guest details could not be fetched, so those stays do not update the guest.
+            stays_with_guest, stays_without_guest, stays_without_phone = [], [], []
+            for reservation, details, phone in zip(reservations, guest_details, phones):
+                stay = Stay(
+                    hotel=self.hotel,
+                    pms_reservation_id=reservation["ReservationId"],
+                    pms_guest_id=reservation.get("GuestId"),
+                    status=status_for_reservation(reservation.get("Status"), Stay.Status.UNKNOWN.value),
+                    checkin=parse_date(reservation.get("CheckInDate")),
+                    checkout=parse_date(reservation.get("CheckOutDate")),
+                )
+                if details is None:
+                    stays_without_guest.append(stay)
+                elif phone is None:
+                    stays_without_phone.append(stay)
+                else:
+                    stay.guest = guests.get(phone)
+                    stays_with_guest.append(stay)
+
+            # Guests without a valid phone number are not stored, which the API returns a lot. Their stays
+            # keep the current guest, unless the reservation now belongs to another guest of the PMS.
+            if stays_without_phone:
+                current_pms_guest_ids = dict(
+                    Stay.objects.filter(
+                        hotel=self.hotel, pms_reservation_id__in=[s.pms_reservation_id for s in stays_without_phone]
+                    ).values_list("pms_reservation_id", "pms_guest_id")
+                )
+                for stay in stays_without_phone:
+                    if current_pms_guest_ids.get(stay.pms_reservation_id) in (None, stay.pms_guest_id):
+                        stays_without_guest.append(stay)
+                    else:
+                        stays_with_guest.append(stay)
+
+            update_fields = ["pms_guest_id", "status", "checkin", "checkout", "updated_at"]
+            for stays, stay_update_fields in [
+                (stays_with_guest, ["guest", *update_fields]),
+                (stays_without_guest, update_fields),
+            ]:
+                if stays:
+                    Stay.objects.bulk_create(
+                        stays,
+                        update_conflicts=True,
+                        unique_fields=["hotel", "pms_reservation_id"],
+                        update_fields=stay_update_fields,
+                    )
 
-    def handle_webhook(self, webhook_data: dict) -> bool:
-        return False
+        return success
 
 
 def get_pms(name: str) -> Type[PMS]:
@@ -73,14 +351,7 @@ def get_pms(name: str) -> Type[PMS]:
     This does not return an instance of the class, but the class itself.
     Note, that the name should be the same as the class name without the 'PMS_' prefix.
     """
-    fullname = "PMS_" + name.capitalize()
-    # find all class names in this module
-    # from https://stackoverflow.com/questions/1796180/
-    current_module = sys.modules[__name__]
-    clsnames = [x[0] for x in inspect.getmembers(current_module, inspect.isclass)]
-
-    # if we have a PMS class for the given name, return an instance of it
-    if fullname in clsnames:
-        return getattr(current_module, fullname)
-    else:
+    try:
+        return PMS_REGISTRY[name.lower()]
+    except KeyError:
         raise ValueError(f"No PMS class found for {name}")
@@ -0,0 +1,25 @@
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from hotel.models import Hotel
+from hotel.pms_systems import hotel_id_cache_key
+
+
+@receiver(post_init, sender=Hotel)
+def remember_hotel_pms(sender, instance: Hotel, **kwargs):
+    # The PMS fields as loaded, so the cached ID can be cleared when they change.
+    # Deferred fields are not in __dict__ and are not loaded for this.
+    instance._loaded_pms = (instance.__dict__.get("pms"), instance.__dict__.get("pms_hotel_id"))
+
+
+@receiver([post_save, post_delete], sender=Hotel)
+def clear_hotel_id_cache(sender, instance: Hotel, **kwargs):
+    cache.delete_many(
+        [
+            hotel_id_cache_key(pms, pms_hotel_id)
+            for pms, pms_hotel_id in {instance._loaded_pms, (instance.pms, instance.pms_hotel_id)}
+            if pms and pms_hotel_id
+        ]
+    )
+    instance._loaded_pms = (instance.pms, instance.pms_hotel_id)
@@ -0,0 +1,83 @@
+import datetime
+import hashlib
+import json
+import logging
+from typing import Optional
+
+from celery import shared_task
+from django.utils import timezone
+
+from hotel.models import Hotel, ProcessedWebhook
+
+
+logger = logging.getLogger(__name__)
+
+# A claim that did not complete within this time is taken over, e.g. if the worker handling it died.
+WEBHOOK_CLAIM_TIMEOUT = datetime.timedelta(minutes=2)
+
+# How long handled webhooks are remembered, well beyond the time a webhook can spend being retried.
+PROCESSED_WEBHOOK_RETENTION = datetime.timedelta(days=1)
+
+
+def webhook_payload_hash(hotel_id: int, webhook_data: dict) -> str:
+    return hashlib.sha256(json.dumps([hotel_id, webhook_data], sort_keys=True).encode()).hexdigest()
+
+
+def handle_webhook(hotel_id: int, webhook_data: dict, retry_key: Optional[str] = None) -> bool:
+    """
+    Handles a cleaned webhook payload for the given hotel, returns whether it was handled successfully.
+    Retries of the same webhook pass the same retry_key, see PMS.handle_webhook.
+    """
+    hotel = Hotel.objects.filter(id=hotel_id).first()
+    # The hotel can have been deleted or moved to another PMS since the webhook was received.
+    pms = hotel.get_pms() if hotel else None
+    if pms is None:
+        logger.warning("Hotel %s no longer has a PMS, can not handle its webhook", hotel_id)
+        return False
+    # The webhook can have been matched to the hotel by an outdated cached hotel ID of another process.
+    if hotel.pms_hotel_id != webhook_data["HotelId"]:
+        logger.warning("Webhook for %s does not belong to hotel %s", webhook_data["HotelId"], hotel_id)
+        return False
+    return pms.handle_webhook(webhook_data, retry_key)
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=60, autoretry_for=(Exception,))
+def process_webhook(self, hotel_id: int, webhook_data: dict, received_at: str) -> None:
+    """
+    Handles a cleaned webhook payload for the given hotel.
+    The webhook is skipped if an identical webhook was handled since it was received at received_at (ISO format),
+    for instance when the PMS sends it again. The task is retried if an identical webhook is being handled, or if not
+    all details could be fetched from the PMS.
+    """
+    payload_hash = webhook_payload_hash(hotel_id, webhook_data)
+    received_at = datetime.datetime.fromisoformat(received_at)
+    started_at = ProcessedWebhook.claim(payload_hash, received_at, stale_after=WEBHOOK_CLAIM_TIMEOUT)
+    if started_at is None:
+        if ProcessedWebhook.is_handled_since(payload_hash, received_at):
+            logger.info("Skipping webhook %s for hotel %s, it was already handled", payload_hash, hotel_id)
+            return
+        # An identical webhook is being handled, check again once it is done.
+        raise self.retry()
+
+    completed = False
+    try:
+        # Retries of a task keep its ID, so they reuse the guest details fetched by earlier attempts.
+        if not handle_webhook(hotel_id, webhook_data, retry_key=self.request.id):
+            raise self.retry()
+        completed = True
+    finally:
+        # The claim is released on any failure, so the retry and identical webhooks are handled again.
+        # If the worker dies instead, the claim is taken over once it is stale.
+        if completed:
+            ProcessedWebhook.complete(payload_hash, started_at)
+        else:
+            ProcessedWebhook.release(payload_hash, started_at)
+
+
+@shared_task
+def prune_processed_webhooks() -> None:
+    """
+    Deletes the claims of old webhooks, run periodically by Celery beat (see CELERY_BEAT_SCHEDULE).
+    Claims are only needed while identical webhooks can still be waiting in the queue or for a retry.
+    """
+    ProcessedWebhook.objects.filter(started_at__lt=timezone.now() - PROCESSED_WEBHOOK_RETENTION).delete()
@@ -1,13 +1,65 @@
+import datetime
+import json
+from unittest import mock
+
+from celery.exceptions import Retry
 import django.test
+from django.core.cache import cache
+from django.utils import timezone
+from kombu.exceptions import OperationalError
 
-from hotel.models import Stay, Hotel, Guest
+from hotel.external_api import APIError
+from hotel.models import Stay, Hotel, Guest, Language, ProcessedWebhook
+from hotel.pms_systems import PMS_Apaleo, get_pms, parse_date
+from hotel.tasks import (
+    WEBHOOK_CLAIM_TIMEOUT,
+    handle_webhook,
+    process_webhook,
+    prune_processed_webhooks,
+    webhook_payload_hash,
+)
 
+from hotel.utils import normalize_phone_number
 from hotel.tests import load_api_fixture
 from hotel.tests.factories import HotelFactory
 
 
+GUESTS = {
+    "5a9469b7-f13f-4a8d-b092-afe400fd7721": ("John Doe", "+442071234567", "GB"),
+    "7c22cb23-c517-48f9-a5d4-da811043bd67": ("Jane Doe", "+61491570156", "AU"),
+    "7c22cb23-c517-48f9-a5d4-da811023bd67": ("Izzy", "+31201234567", None),
+}
+
+
+def fake_reservation_details(reservation_id: str) -> str:
+    return json.dumps(
+        {
+            "HotelId": "851df8c8-90f2-4c4a-8e01-a4fc46b25178",
+            "ReservationId": reservation_id,
+            "GuestId": f"guest-{reservation_id}",
+            "Status": "in_house",
+            "CheckInDate": "2024-01-20",
+            "CheckOutDate": "2024-01-25",
+            "BreakfastIncluded": True,
+            "RoomNumber": 12,
+        }
+    )
+
+
+def fake_guest_details(guest_id: str) -> str:
+    name, phone, country = GUESTS[guest_id.removeprefix("guest-")]
+    return json.dumps({"GuestId": guest_id, "Name": name, "Phone": phone, "Country": country})
+
+
+def unavailable_api(object_id: str) -> str:
+    raise APIError("The API is temporarily not available. Please try again.")
+
+
+@mock.patch("hotel.external_api.get_guest_details", fake_guest_details)
+@mock.patch("hotel.external_api.get_reservation_details", fake_reservation_details)
 class PMS_Apaleotest(django.test.TestCase):
     def setUp(self) -> None:
+        cache.clear()
         self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
         self.pms = self.hotel.get_pms()
 
@@ -20,13 +72,321 @@ class PMS_Apaleotest(django.test.TestCase):
         if not cleaned_payload:
             self.fail("No cleaned payload returned")
         else:
-            self.assertEqual(len(cleaned_payload["Events"]), 3)
+            self.assertEqual(cleaned_payload["hotel_id"], self.hotel.id)
+            self.assertEqual(len(cleaned_payload["data"]["Events"]), 3)
+
+    def test_clean_webhook_payload_caches_hotel(self):
+        self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        with self.assertNumQueries(0):
+            cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        self.assertEqual(cleaned_payload["hotel_id"], self.hotel.id)
+
+        self.hotel.delete()
+        self.assertIsNone(self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json")))
+
+    def test_clean_webhook_payload_hotel_pms_changed(self):
+        self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        hotel = Hotel.objects.get(id=self.hotel.id)
+        hotel.pms = None
+        hotel.save()
+        self.assertIsNone(self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json")))
+
+    def test_clean_webhook_payload_pms_hotel_id_changed(self):
+        self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        hotel = Hotel.objects.get(id=self.hotel.id)
+        hotel.pms_hotel_id = "another-hotel"
+        hotel.save()
+        self.assertIsNone(self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json")))
 
     def test_handle_webhook(self):
         cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
-        success = self.pms.handle_webhook(cleaned_payload)
+        success = self.pms.handle_webhook(cleaned_payload["data"])
         self.assertTrue(success)
         stays = Stay.objects.filter(hotel=self.hotel)
         self.assertEqual(stays.count(), 3)
         guests = Guest.objects.all()
         self.assertEqual(guests.count(), 3)
+        self.assertEqual(guests.get(phone="+31201234567").language, Language.BRITISH_ENGLISH)
+
+    def test_handle_webhook_updates_existing(self):
+        guest = Guest.objects.create(name="J. Doe", phone="+442071234567")
+        stay = Stay.objects.create(hotel=self.hotel, pms_reservation_id="5a9469b7-f13f-4a8d-b092-afe400fd7721")
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+
+        with self.assertNumQueries(6):
+            self.assertTrue(self.pms.handle_webhook(cleaned_payload["data"]))
+
+        guest.refresh_from_db()
+        self.assertEqual(guest.name, "John Doe")
+        self.assertEqual(guest.language, Language.BRITISH_ENGLISH)
+        stay.refresh_from_db()
+        self.assertEqual(stay.guest, guest)
+        self.assertEqual(stay.status, Stay.Status.INSTAY)
+        self.assertEqual(str(stay.checkin), "2024-01-20")
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel).count(), 3)
+
+    def test_handle_webhook_api_error(self):
+        guest = Guest.objects.create(name="John Doe", phone="+442071234567")
+        stay = Stay.objects.create(
+            hotel=self.hotel, guest=guest, pms_reservation_id="5a9469b7-f13f-4a8d-b092-afe400fd7721"
+        )
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        with mock.patch("hotel.external_api.get_guest_details", unavailable_api):
+            self.assertFalse(self.pms.handle_webhook(cleaned_payload["data"]))
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel, guest__isnull=True).count(), 2)
+        self.assertEqual(Guest.objects.count(), 1)
+        stay.refresh_from_db()
+        self.assertEqual(stay.guest, guest)
+        self.assertEqual(stay.status, Stay.Status.INSTAY)
+
+    def test_handle_webhook_invalid_reservation_details(self):
+        def invalid_reservation_details(reservation_id: str) -> str:
+            details = json.loads(fake_reservation_details(reservation_id))
+            if reservation_id == "5a9469b7-f13f-4a8d-b092-afe400fd7721":
+                del details["GuestId"]
+            else:
+                details["ReservationId"] = "something-else"
+            return json.dumps(details)
+
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        with mock.patch("hotel.external_api.get_reservation_details", invalid_reservation_details):
+            self.assertFalse(self.pms.handle_webhook(cleaned_payload["data"]))
+        self.assertQuerySetEqual(
+            Stay.objects.filter(hotel=self.hotel).values_list("pms_reservation_id", flat=True),
+            ["7c22cb23-c517-48f9-a5d4-da811043bd67", "7c22cb23-c517-48f9-a5d4-da811023bd67"],
+            ordered=False,
+        )
+
+    def test_handle_webhook_invalid_guest_details(self):
+        def invalid_guest_details(guest_id: str) -> str:
+            return json.dumps({"GuestId": guest_id, "Name": 42, "Phone": 442071234567, "Country": ["GB"]})
+
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        with mock.patch("hotel.external_api.get_guest_details", invalid_guest_details):
+            self.assertTrue(self.pms.handle_webhook(cleaned_payload["data"]))
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel, guest__isnull=True).count(), 3)
+        self.assertFalse(Guest.objects.exists())
+
+    def test_handle_webhook_guest_without_phone(self):
+        def guest_details_without_phone(guest_id: str) -> str:
+            details = json.loads(fake_guest_details(guest_id))
+            details["Phone"] = "Not available"
+            return json.dumps(details)
+
+        guest = Guest.objects.create(name="John Doe", phone="+442071234567")
+        same_guest_stay = Stay.objects.create(
+            hotel=self.hotel,
+            guest=guest,
+            pms_reservation_id="5a9469b7-f13f-4a8d-b092-afe400fd7721",
+            pms_guest_id="guest-5a9469b7-f13f-4a8d-b092-afe400fd7721",
+        )
+        other_guest_stay = Stay.objects.create(
+            hotel=self.hotel,
+            guest=guest,
+            pms_reservation_id="7c22cb23-c517-48f9-a5d4-da811043bd67",
+            pms_guest_id="guest-5a9469b7-f13f-4a8d-b092-afe400fd7721",
+        )
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        with mock.patch("hotel.external_api.get_guest_details", guest_details_without_phone):
+            self.assertTrue(self.pms.handle_webhook(cleaned_payload["data"]))
+        same_guest_stay.refresh_from_db()
+        self.assertEqual(same_guest_stay.guest, guest)
+        self.assertEqual(same_guest_stay.status, Stay.Status.INSTAY)
+        other_guest_stay.refresh_from_db()
+        self.assertIsNone(other_guest_stay.guest)
+        self.assertEqual(Guest.objects.count(), 1)
+
+    def test_handle_webhook_caches_guest_details(self):
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        self.assertTrue(self.pms.handle_webhook(cleaned_payload["data"], retry_key="task-1"))
+        with mock.patch("hotel.external_api.get_guest_details", unavailable_api):
+            self.assertTrue(self.pms.handle_webhook(cleaned_payload["data"], retry_key="task-1"))
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel, guest__isnull=False).count(), 3)
+
+    def test_handle_webhook_later_webhook_updates_guest(self):
+        def renamed_guest_details(guest_id: str) -> str:
+            details = json.loads(fake_guest_details(guest_id))
+            details["Name"] = details["Name"].upper()
+            return json.dumps(details)
+
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        self.assertTrue(self.pms.handle_webhook(cleaned_payload["data"], retry_key="task-1"))
+        with mock.patch("hotel.external_api.get_guest_details", renamed_guest_details):
+            self.assertTrue(self.pms.handle_webhook(cleaned_payload["data"], retry_key="task-2"))
+        self.assertQuerySetEqual(
+            Guest.objects.values_list("name", flat=True), ["JOHN DOE", "JANE DOE", "IZZY"], ordered=False
+        )
+
+    def test_handle_webhook_fetches_guest_once(self):
+        def same_guest_reservation_details(reservation_id: str) -> str:
+            details = json.loads(fake_reservation_details(reservation_id))
+            details["GuestId"] = "guest-5a9469b7-f13f-4a8d-b092-afe400fd7721"
+            return json.dumps(details)
+
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        with (
+            mock.patch("hotel.external_api.get_reservation_details", same_guest_reservation_details),
+            mock.patch("hotel.external_api.get_guest_details", side_effect=fake_guest_details) as get_guest_details,
+        ):
+            self.assertTrue(self.pms.handle_webhook(cleaned_payload["data"]))
+        get_guest_details.assert_called_once_with("guest-5a9469b7-f13f-4a8d-b092-afe400fd7721")
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel, guest__phone="+442071234567").count(), 3)
+
+
+@mock.patch("hotel.external_api.get_guest_details", fake_guest_details)
+@mock.patch("hotel.external_api.get_reservation_details", fake_reservation_details)
+class WebhookViewTest(django.test.TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+
+    def post_webhook(self, fixture: str):
+        return self.client.post("/webhook/apaleo/", data=load_api_fixture(fixture), content_type="application/json")
+
+    def test_webhook(self):
+        response = self.post_webhook("webhook_payload.json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel).count(), 3)
+
+    def test_webhook_faulty(self):
+        response = self.post_webhook("webhook_payload_faulty.json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Stay.objects.exists())
+
+    def test_webhook_failed(self):
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=False) as handle_webhook:
+            response = self.post_webhook("webhook_payload.json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(handle_webhook.call_count, 1)
+
+    @django.test.override_settings(CELERY_TASK_ALWAYS_EAGER=False)
+    def test_webhook_enqueued(self):
+        with mock.patch("hotel.tasks.process_webhook.delay") as delay:
+            response = self.post_webhook("webhook_payload.json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(delay.call_args.args[0], self.hotel.id)
+        self.assertFalse(Stay.objects.exists())
+
+    @django.test.override_settings(CELERY_TASK_ALWAYS_EAGER=False)
+    def test_webhook_queue_unavailable(self):
+        with mock.patch("hotel.tasks.process_webhook.delay", side_effect=OperationalError):
+            with self.assertLogs("hotel.views", level="ERROR"):
+                response = self.post_webhook("webhook_payload.json")
+        self.assertEqual(response.status_code, 503)
+
+
+class NormalizePhoneNumberTest(django.test.SimpleTestCase):
+    def test_international_number(self):
+        self.assertEqual(normalize_phone_number("+44 20 7123 4567"), "+442071234567")
+        self.assertEqual(normalize_phone_number("+442071234567", "NL"), "+442071234567")
+
+    def test_national_number(self):
+        self.assertEqual(normalize_phone_number("020 1234567", "NL"), "+31201234567")
+        self.assertIsNone(normalize_phone_number("020 1234567"))
+        self.assertEqual(normalize_phone_number("4002", "NU"), "+6834002")
+
+    def test_invalid_number(self):
+        for phone_number in [None, "", "123", "Not available", "+491234567890"]:
+            with self.subTest(phone_number=phone_number):
+                self.assertIsNone(normalize_phone_number(phone_number, "DE"))
+
+
+class ParseDateTest(django.test.SimpleTestCase):
+    def test_parse_date(self):
+        self.assertEqual(parse_date("2024-01-20"), datetime.date(2024, 1, 20))
+
+    def test_parse_date_invalid(self):
+        for value in [None, "", "2024-13-01", "20-01-2024", "20240120", "2024-W03-6", 20240120]:
+            with self.subTest(value=value):
+                self.assertIsNone(parse_date(value))
+
+
+class GetPMSTest(django.test.SimpleTestCase):
+    def test_get_pms(self):
+        self.assertIs(get_pms("apaleo"), PMS_Apaleo)
+        self.assertIs(get_pms(Hotel.PMS.APALEO), PMS_Apaleo)
+
+    def test_get_pms_unknown(self):
+        with self.assertRaises(ValueError):
+            get_pms("unknown")
+
+
+class ProcessWebhookTest(django.test.TestCase):
+    def setUp(self) -> None:
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+        self.webhook_data = PMS_Apaleo.clean_webhook_payload(load_api_fixture("webhook_payload.json"))["data"]
+        self.payload_hash = webhook_payload_hash(self.hotel.id, self.webhook_data)
+
+    def test_skips_handled_webhook(self):
+        received_at = timezone.now().isoformat()
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=True) as handle_webhook:
+            process_webhook(self.hotel.id, self.webhook_data, received_at)
+            process_webhook(self.hotel.id, self.webhook_data, received_at)
+            self.assertEqual(handle_webhook.call_count, 1)
+
+            process_webhook(self.hotel.id, self.webhook_data, timezone.now().isoformat())
+            self.assertEqual(handle_webhook.call_count, 2)
+
+    def test_claim_queries(self):
+        # Claiming the webhook, looking up the hotel and completing the claim.
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=True):
+            with self.assertNumQueries(3):
+                process_webhook(self.hotel.id, self.webhook_data, timezone.now().isoformat())
+
+    def test_handles_failed_webhook_again(self):
+        received_at = timezone.now().isoformat()
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=False):
+            with self.assertRaises(Retry):
+                process_webhook(self.hotel.id, self.webhook_data, received_at)
+        self.assertFalse(ProcessedWebhook.objects.exists())
+
+    def test_handles_crashed_webhook_again(self):
+        received_at = timezone.now().isoformat()
+        # Called directly, the task raises the error instead of retrying.
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                process_webhook(self.hotel.id, self.webhook_data, received_at)
+        self.assertFalse(ProcessedWebhook.objects.exists())
+
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=True) as handle_webhook:
+            process_webhook(self.hotel.id, self.webhook_data, received_at)
+        self.assertEqual(handle_webhook.call_count, 1)
+
+    def test_waits_for_webhook_in_progress(self):
+        received_at = timezone.now()
+        ProcessedWebhook.objects.create(payload_hash=self.payload_hash, started_at=timezone.now())
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=True) as handle_webhook:
+            with self.assertRaises(Retry):
+                process_webhook(self.hotel.id, self.webhook_data, received_at.isoformat())
+        self.assertEqual(handle_webhook.call_count, 0)
+
+    def test_takes_over_stale_claim(self):
+        # E.g. the worker died while handling this message, which is then delivered again.
+        received_at = timezone.now() - WEBHOOK_CLAIM_TIMEOUT * 2
+        ProcessedWebhook.objects.create(payload_hash=self.payload_hash, started_at=received_at)
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=True) as handle_webhook:
+            process_webhook(self.hotel.id, self.webhook_data, received_at.isoformat())
+        self.assertEqual(handle_webhook.call_count, 1)
+        self.assertTrue(ProcessedWebhook.is_handled_since(self.payload_hash, received_at))
+
+    def test_webhook_for_another_hotel(self):
+        # E.g. another process still had the hotel ID cached after the PMS hotel ID moved to another hotel.
+        Hotel.objects.filter(id=self.hotel.id).update(pms_hotel_id="another-hotel")
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=True) as pms_handle_webhook:
+            with self.assertLogs("hotel.tasks", level="WARNING"):
+                self.assertFalse(handle_webhook(self.hotel.id, self.webhook_data))
+        pms_handle_webhook.assert_not_called()
+
+    def test_release_keeps_newer_claim(self):
+        started_at = ProcessedWebhook.claim(self.payload_hash, timezone.now(), WEBHOOK_CLAIM_TIMEOUT)
+        newer_started_at = ProcessedWebhook.claim(self.payload_hash, timezone.now(), WEBHOOK_CLAIM_TIMEOUT)
+        ProcessedWebhook.release(self.payload_hash, started_at)
+        self.assertEqual(ProcessedWebhook.objects.get().started_at, newer_started_at)
+
+    def test_prunes_old_webhooks(self):
+        two_days_ago = timezone.now() - datetime.timedelta(days=2)
+        ProcessedWebhook.objects.create(payload_hash="old", started_at=two_days_ago, completed_at=two_days_ago)
+        with mock.patch.object(PMS_Apaleo, "handle_webhook", return_value=True):
+            process_webhook(self.hotel.id, self.webhook_data, timezone.now().isoformat())
+        prune_processed_webhooks()
+        self.assertQuerySetEqual(ProcessedWebhook.objects.values_list("payload_hash", flat=True), [self.payload_hash])
@@ -0,0 +1,66 @@
+import functools
+import re
+from typing import Optional
+
+import phonenumbers
+
+from hotel.models import Language, Stay
+
+
+# Maps the country code of a guest, as returned by the PMS, to the language we talk to them in.
+# New guests from other or unknown countries get the DEFAULT_LANGUAGE.
+LANGUAGE_MAPPINGS: dict[str, Language] = {
+    "AT": Language.GERMAN,
+    "AU": Language.BRITISH_ENGLISH,
+    "BE": Language.DUTCH,
+    "CA": Language.BRITISH_ENGLISH,
+    "CH": Language.GERMAN,
+    "DE": Language.GERMAN,
+    "DK": Language.DANISH,
+    "ES": Language.SPANISH_SPAIN,
+    "FR": Language.FRENCH,
+    "GB": Language.BRITISH_ENGLISH,
+    "GG": Language.BRITISH_ENGLISH,
+    "IE": Language.BRITISH_ENGLISH,
+    "IT": Language.ITALIAN,
+    "NL": Language.DUTCH,
+    "NZ": Language.BRITISH_ENGLISH,
+    "PT": Language.PORTUGUESE_PORTUGAL,
+    "SE": Language.SWEDISH,
+}
+
+DEFAULT_LANGUAGE = Language.BRITISH_ENGLISH
+
+# Maps the reservation status of the PMS to the status value of a Stay.
+STATUS_MAPPINGS: dict[str, str] = {
+    "in_house": Stay.Status.INSTAY.value,
+    "checked_out": Stay.Status.AFTER.value,
+    "cancelled": Stay.Status.CANCEL.value,
+    "no_show": Stay.Status.CANCEL.value,
+    "not_confirmed": Stay.Status.BEFORE.value,
+    "booked": Stay.Status.BEFORE.value,
+}
+
+
+# Valid phone numbers have at least 4 digits (national numbers of Niue), anything shorter
+# is rejected before it reaches phonenumbers, e.g. "123" or "Not available".
+PLAUSIBLE_PHONE_NUMBER = re.compile(r"(?:\D*\d){4}")
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize_phone_number(phone_number: Optional[str], country: Optional[str] = None) -> Optional[str]:
+    """
+    Returns the phone number in E.164 format, or None if it is not a valid phone number.
+    Guests are identified by their phone number, so all numbers are stored in the same format.
+    Numbers without an international prefix are parsed as numbers of the given country.
+    The same numbers come up again and again, so the results are cached.
+    """
+    if not phone_number or not PLAUSIBLE_PHONE_NUMBER.match(phone_number):
+        return None
+    try:
+        parsed = phonenumbers.parse(phone_number, None if phone_number.startswith("+") else country or None)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_valid_number(parsed):
+        return None
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
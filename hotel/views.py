@@ -1,10 +1,19 @@
+import logging
+
+from amqp.exceptions import MessageNacked
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.http import HttpResponse
+from django.utils import timezone
+from kombu.exceptions import OperationalError
 
 from hotel import pms_systems
 
-from hotel.models import Hotel
+from hotel.tasks import handle_webhook, process_webhook
+
+
+logger = logging.getLogger(__name__)
 
 
 @csrf_exempt
@@ -14,6 +23,7 @@ def webhook(request, pms_name):
     Assume a webhook call from the PMS with a status update for a reservation.
     The webhook call is a POST request to the url: /webhook/<pms_name>/
     The body of the request should always be a valid JSON string and contain the needed information to perform an update.
+    The webhook is only validated here, the update itself is handled by a Celery worker if a broker is configured.
     """
 
     pms_cls = pms_systems.get_pms(pms_name)
@@ -21,11 +31,21 @@ def webhook(request, pms_name):
     cleaned_webhook_payload = pms_cls.clean_webhook_payload(request.body)
     if not cleaned_webhook_payload:
         return HttpResponse(status=400)
-    hotel = Hotel.objects.get(id=cleaned_webhook_payload["hotel_id"])
-    pms = hotel.get_pms()
-    success = pms.handle_webhook(cleaned_webhook_payload["data"])
 
-    if not success:
-        return HttpResponse(status=400)
-    else:
+    if settings.CELERY_TASK_ALWAYS_EAGER:
+        # Without a broker the webhook is handled right away, without retries. A failure is
+        # reported to the PMS instead, so it sends the webhook again.
+        if not handle_webhook(cleaned_webhook_payload["hotel_id"], cleaned_webhook_payload["data"]):
+            return HttpResponse(status=400)
         return HttpResponse("Thanks for the update.")
+
+    try:
+        process_webhook.delay(
+            cleaned_webhook_payload["hotel_id"], cleaned_webhook_payload["data"], timezone.now().isoformat()
+        )
+    except (OperationalError, MessageNacked):
+        # The queue is full or unavailable, the PMS will send the webhook again.
+        logger.exception("Could not enqueue webhook for hotel %s", cleaned_webhook_payload["hotel_id"])
+        return HttpResponse(status=503)
+
+    return HttpResponse("Thanks for the update.")
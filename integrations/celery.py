@@ -0,0 +1,21 @@
+"""
+Celery config for integrations project.
+
+Webhooks are acknowledged by the view and handled by a Celery worker, started with:
+    celery -A integrations worker -Q webhooks
+and the periodic tasks by Celery beat, started with:
+    celery -A integrations beat
+
+For more information on this file, see
+https://docs.celeryq.dev/en/stable/django/first-steps-with-django.html
+"""
+
+import os
+
+from celery import Celery
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "integrations.settings")
+
+app = Celery("integrations")
+app.config_from_object("django.conf:settings", namespace="CELERY")
+app.autodiscover_tasks()
@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from kombu import Queue
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -78,6 +81,9 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Keep connections open between requests and tasks, instead of connecting for each webhook.
+        "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", 60)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
@@ -122,3 +128,53 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# The web server and the Celery workers share the cache, so keys cleared by one are cleared for all
+# of them. Without a REDIS_CACHE_URL, each process has its own cache, see HOTEL_ID_CACHE_TIMEOUT.
+if os.environ.get("REDIS_CACHE_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_CACHE_URL"],
+        }
+    }
+else:
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+# Celery
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html
+
+# Without a broker, tasks are executed in the process that enqueues them, so no external services are needed.
+CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL")
+CELERY_TASK_ALWAYS_EAGER = not CELERY_BROKER_URL
+
+# Webhooks go to a bounded queue. When it is full, publishing is rejected (RabbitMQ), and the
+# webhook view answers with a 503, so the PMS sends the webhook again later.
+CELERY_TASK_DEFAULT_QUEUE = "webhooks"
+CELERY_TASK_QUEUES = [
+    Queue(
+        "webhooks",
+        queue_arguments={
+            "x-max-length": int(os.environ.get("WEBHOOK_QUEUE_MAX_LENGTH", 10000)),
+            "x-overflow": "reject-publish",
+        },
+    ),
+]
+CELERY_BROKER_TRANSPORT_OPTIONS = {"confirm_publish": True}
+
+# Tasks are only acknowledged once they are done, and a worker only reserves one task at a time.
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Old webhook claims are deleted once an hour, instead of while handling webhooks.
+CELERY_BEAT_SCHEDULE = {
+    "prune-processed-webhooks": {
+        "task": "hotel.tasks.prune_processed_webhooks",
+        "schedule": 60 * 60,
+    },
+}